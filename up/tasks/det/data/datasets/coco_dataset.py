@@ -82,9 +82,13 @@ class CocoDataset(BaseDataset):
                  use_ignore=False,
                  evaluator=None,
                  cache=None,
-                 clip_box=True):
+                 clip_box=True,
+                 streaming=False):
         with no_print():
-            self.coco = self._loader(meta_file)
+            if streaming:
+                self.coco = self._loader(meta_file, streaming=streaming)
+            else:
+                self.coco = self._loader(meta_file)
 
         category_ids = self.coco.cats.keys()
 
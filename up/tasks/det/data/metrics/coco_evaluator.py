@@ -26,17 +26,19 @@ __all__ = ['CocoEvaluator']
 class CocoEvaluator(Evaluator):
     """Evaluator for coco"""
 
-    def __init__(self, gt_file, iou_types=['bbox']):
+    def __init__(self, gt_file, iou_types=['bbox'], streaming=False):
         """
         Arguments:
             gt_file (str): directory or json file of annotations
             iou_types (str): list of iou types of [keypoints, bbox, segm]
+            streaming (bool): parse gt_file incrementally instead of reading it into memory first
         """
         super(CocoEvaluator, self).__init__()
         anno_file, self.iou_types, self.use_cats = self.iou_type_to_setting(iou_types)
         if os.path.isdir(gt_file):
             gt_file = os.path.join(gt_file, anno_file)
         self.gt_file = gt_file
+        self.streaming = streaming
         # self.gt_loaded = False
 
     def iou_type_to_setting(self, itypes):
@@ -96,7 +98,7 @@ class CocoEvaluator(Evaluator):
         # if not self.gt_loaded:
         #     self.gts = COCO(self.gt_file)
         #     self.gt_loaded = True
-        self.gts = COCO(self.gt_file)
+        self.gts = COCO(self.gt_file, streaming=self.streaming)
         dts = self.load_dts(res_file, res)
         dts = self.gts.loadRes(dts)
 
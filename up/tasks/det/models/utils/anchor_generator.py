@@ -1,8 +1,8 @@
-import json
 import numpy as np
 import torch
 
 from up.utils.general.log_helper import default_logger as logger
+from up.utils.general.petrel_helper import PetrelHelper
 from up.utils.general.registry_factory import ANCHOR_GENERATOR_REGISTRY
 from up.utils.general.global_flag import ALIGNED_FLAG
 
@@ -16,11 +16,33 @@ __all__ = [
     'PointAnchorGenerator']
 
 
+def _strides_key(strides):
+    return tuple(s.item() if isinstance(s, torch.Tensor) else s for s in strides)
+
+
+def _enum_anchors_over_grid(ratios, scales, stride):
+    """enumerate ratio x scale anchors of the (0, 0, stride - 1, stride - 1) window,
+    ratio major, same as _ratio_enum followed by _scale_enum on each ratio anchor
+    """
+    ctr = 0.5 * (stride - 1)
+    ws = np.round(np.sqrt(stride * stride / ratios))
+    hs = np.round(ws * ratios)
+    ws = (ws[:, None] * scales[None, :]).reshape(-1, 1)
+    hs = (hs[:, None] * scales[None, :]).reshape(-1, 1)
+    return np.hstack((ctr - 0.5 * (ws - 1), ctr - 0.5 * (hs - 1),
+                      ctr + 0.5 * (ws - 1), ctr + 0.5 * (hs - 1)))
+
+
 class AnchorGenerator(object):
+    # anchors are cached per featmap shape, bound the cache for multi-scale inputs
+    _max_cache_size = 64
+
     def __init__(self):
         self._num_anchors = None
         self._num_level = None
         self._base_anchors = None
+        # base anchors built for each set of strides
+        self._base_anchors_cache = {}
 
     def build_base_anchors(self, anchor_strides):
         """ build anchors over one cell
@@ -53,30 +75,60 @@ class AnchorGenerator(object):
 
 
 class BoxAnchorGenerator(AnchorGenerator):
+    def __init__(self):
+        super(BoxAnchorGenerator, self).__init__()
+        self._plane_cache = {}
+        # base anchors moved to each device
+        self._device_cache = {}
 
-    def get_anchors(self, featmap_shapes, device=None):
+    def get_anchors(self, featmap_shapes, device=None, dtype=torch.float32):
         """
         Arguments:
           - featmap_shapes: (list of tuple of (h, w, h*w*a, stride))
+          - dtype: dtype of anchors, pass torch.float16/bfloat16 to get half anchors for AMP
 
         Returns:
           - mlvl_anchors: (list of anchors of (h*w*a, 4))
         """
-        strides = [shp[-1] for shp in featmap_shapes]
+        # necks hand out strides as tensors, a new object every forward, key the caches on their values
+        strides = _strides_key(shp[-1] for shp in featmap_shapes)
         base_anchors = self.build_base_anchors(strides)
+        base_anchors = self.get_device_base_anchors(base_anchors, strides, device=device)
         # logger.info(f'{self._anchor_ratios}, {self._anchor_scales}, {self._anchor_strides}')
         mlvl_anchors = []
-        for anchors_over_grid, featmap_shape, in zip(base_anchors, featmap_shapes):
+        for lvl, (anchors_over_grid, featmap_shape) in enumerate(zip(base_anchors, featmap_shapes)):
             featmap_h = featmap_shape[0]
             featmap_w = featmap_shape[1]
-            featmap_stride = featmap_shape[-1]
-            anchors = self.get_anchors_over_plane(
-                anchors_over_grid, featmap_h, featmap_w, featmap_stride, device=device)
+            featmap_stride = strides[lvl]
+            # anchors over plane only depend on the base anchors of (level, stride) and the featmap size
+            key = (lvl, featmap_stride, featmap_h, featmap_w, dtype, str(device))
+            anchors = self._plane_cache.get(key, None)
+            if anchors is None:
+                anchors = self.get_anchors_over_plane(
+                    anchors_over_grid, featmap_h, featmap_w, featmap_stride, dtype=dtype, device=device)
+                if len(self._plane_cache) >= self._max_cache_size:
+                    self._plane_cache.clear()
+                self._plane_cache[key] = anchors
             mlvl_anchors.append(anchors)
             # logger.info(f'featmap_shape:{featmap_shape}, anchor_shape:{anchors.shape}')
             # logger.debug('anchors:{}'.format(anchors.shape))
         return mlvl_anchors
 
+    def get_device_base_anchors(self, base_anchors, strides, device=None):
+        """
+        Move base anchors built for strides to device once and keep them there
+
+        Returns:
+          - per level tensors of (A, 4)
+        """
+        key = (_strides_key(strides), str(device))
+        mlvl_anchors = self._device_cache.get(key, None)
+        if mlvl_anchors is None:
+            mlvl_anchors = [torch.as_tensor(anchors).to(device=device, dtype=torch.float32)
+                            for anchors in base_anchors]
+            self._device_cache[key] = mlvl_anchors
+        return mlvl_anchors
+
     def get_anchors_over_plane(self,
                                anchors_over_grid,
                                featmap_h,
@@ -88,22 +140,24 @@ class BoxAnchorGenerator(AnchorGenerator):
         Args:
         anchors_over_grid
         """
+        # half anchors are computed in float32 and rounded once at the end
+        compute_dtype = torch.promote_types(dtype, torch.float32)
         # [A, 4], anchors over one pixel
-
-        anchors_over_grid = torch.from_numpy(anchors_over_grid).to(device=device, dtype=dtype)
+        if isinstance(anchors_over_grid, np.ndarray):
+            base_anchors = torch.from_numpy(anchors_over_grid).to(device=device, dtype=compute_dtype)
+        else:
+            base_anchors = anchors_over_grid.to(device=device, dtype=compute_dtype)
         # spread anchors over each grid
-        shift_x = torch.arange(0, featmap_w * featmap_stride, step=featmap_stride, dtype=dtype, device=device)
-        shift_y = torch.arange(0, featmap_h * featmap_stride, step=featmap_stride, dtype=dtype, device=device)
-        # [featmap_h, featmap_w]
-        shift_y, shift_x = torch.meshgrid((shift_y, shift_x))
-        shift_x = shift_x.reshape(-1)
-        shift_y = shift_y.reshape(-1)
-        shifts = torch.stack([shift_x, shift_y, shift_x, shift_y], dim=1)
-
-        anchors_over_grid = anchors_over_grid.reshape(1, -1, 4)
-        shifts = shifts.reshape(-1, 1, 4).to(anchors_over_grid)
-        anchors_overplane = anchors_over_grid + shifts
-        return anchors_overplane.reshape(-1, 4)
+        shift_x = torch.arange(0, featmap_w * featmap_stride, step=featmap_stride, dtype=compute_dtype, device=device)
+        shift_y = torch.arange(0, featmap_h * featmap_stride, step=featmap_stride, dtype=compute_dtype, device=device)
+        # [h*w, 4], row major over [featmap_h, featmap_w], written in place instead of meshgrid + stack
+        shifts = torch.empty((featmap_h * featmap_w, 4), dtype=compute_dtype, device=device)
+        shifts[:, 0] = shifts[:, 2] = shift_x.repeat(featmap_h)
+        shifts[:, 1] = shifts[:, 3] = shift_y.repeat_interleave(featmap_w)
+
+        # [1, A, 4] + [h*w, 1, 4] is already contiguous, so the reshape is a view
+        anchors_overplane = (base_anchors[None] + shifts[:, None]).reshape(-1, 4).to(dtype)
+        return anchors_overplane
 
     def get_anchors_over_grid(self, ratios, scales, stride):
         """
@@ -131,11 +185,9 @@ class BoxAnchorGenerator(AnchorGenerator):
             ]
             anchors = torch.stack(base_anchors, dim=-1).numpy()
         else:
-            ratios = np.array(ratios)
-            scales = np.array(scales)
-            anchor = np.array([1, 1, stride, stride], dtype=np.float) - 1
-            anchors = self._ratio_enum(anchor, ratios)
-            anchors = np.vstack([self._scale_enum(anchors[i, :], scales) for i in range(anchors.shape[0])])
+            ratios = np.array(ratios, dtype=np.float64)
+            scales = np.array(scales, dtype=np.float64)
+            anchors = _enum_anchors_over_grid(ratios, scales, float(stride))
         return anchors
 
     def _ratio_enum(self, anchor, ratios):
@@ -189,13 +241,14 @@ class HandCraftAnchorGenerator(BoxAnchorGenerator):
 
     def build_base_anchors(self, anchor_strides):
         self._anchor_strides = anchor_strides
-        if getattr(self, '_base_anchors', None) is not None:
-            return self._base_anchors
         self._num_level = len(anchor_strides)
-        self._base_anchors = []
-        for idx, stride in enumerate(anchor_strides):
-            anchors_over_grid = self.get_anchors_over_grid(self._anchor_ratios, self._anchor_scales, stride)
-            self._base_anchors.append(anchors_over_grid)
+        key = _strides_key(anchor_strides)
+        base_anchors = self._base_anchors_cache.get(key, None)
+        if base_anchors is None:
+            base_anchors = [self.get_anchors_over_grid(self._anchor_ratios, self._anchor_scales, stride)
+                            for stride in anchor_strides]
+            self._base_anchors_cache[key] = base_anchors
+        self._base_anchors = base_anchors
         # logger.debug('base_anchors:{}'.format(self._base_anchors))
         return self._base_anchors
 
@@ -281,6 +334,12 @@ class SSDAnchorGenerator(BoxAnchorGenerator):
 
         self.ratios  = anchor_ratios
         self.scales  = anchor_scales
+        # move the anchor of the second scale with ratio 1 next to the first one
+        self._anchor_perms = []
+        for anchor_ratio in anchor_ratios:
+            indices = list(range(len(anchor_ratio)))
+            indices.insert(1, len(indices))
+            self._anchor_perms.append(indices)
         self.center_offset = 0
         self.base_sizes = min_sizes
 
@@ -303,11 +362,7 @@ class SSDAnchorGenerator(BoxAnchorGenerator):
                 scales=self.scales[i],
                 ratios=self.ratios[i],
                 center=self.centers[i])
-            indices = list(range(len(self.ratios[i])))
-            indices.insert(1, len(indices))
-            base_anchors = torch.index_select(base_anchors, 0,
-                                                  torch.LongTensor(indices))
-            base_anchors = base_anchors.numpy()
+            base_anchors = base_anchors.numpy()[self._anchor_perms[i]]
             self._num_anchors.append(len(base_anchors))
             self._base_anchors.append(base_anchors)
         return self._base_anchors
@@ -361,9 +416,11 @@ class ClusteredAnchorGenerator(BoxAnchorGenerator):
         super(ClusteredAnchorGenerator, self).__init__()
         self._num_anchors = num_anchors_per_level
         self._num_level = num_level
-        with open(base_anchors_file, 'r') as f:
-            self._shapes = np.array(json.load(f)).reshape(num_level, num_anchors_per_level, 2)
-            assert self._shapes.size == num_anchors_per_level * num_level * 2
+        if base_anchors_file.endswith('.npy'):
+            shapes = PetrelHelper.load_npy(base_anchors_file)
+        else:
+            shapes = PetrelHelper.load_json(base_anchors_file)
+        self._shapes = np.asarray(shapes, dtype=np.float64).reshape(num_level, num_anchors_per_level, 2)
 
     def load_anchors_over_grid(self, whs, stride):
         ws = whs[:, 0]
@@ -373,11 +430,14 @@ class ClusteredAnchorGenerator(BoxAnchorGenerator):
         return self._mkanchors(ws, hs, x_ctr, y_ctr)
 
     def build_base_anchors(self, anchor_strides):
-        if getattr(self, '_base_anchors', None) is not None:
-            return self._base_anchors
-        self._base_anchors = []
-        for shape, stride in zip(self._shapes, anchor_strides):
-            self._base_anchors.append(self.load_anchors_over_grid(shape, stride))
+        key = _strides_key(anchor_strides)
+        base_anchors = self._base_anchors_cache.get(key, None)
+        if base_anchors is None:
+            base_anchors = []
+            for shape, stride in zip(self._shapes, anchor_strides):
+                base_anchors.append(self.load_anchors_over_grid(shape, stride))
+            self._base_anchors_cache[key] = base_anchors
+        self._base_anchors = base_anchors
 
         return self._base_anchors
 
@@ -398,6 +458,7 @@ class PointAnchorGenerator(AnchorGenerator):
         super(PointAnchorGenerator, self).__init__()
         self.dense_points = dense_points
         self.center = center
+        self._loc_cache = {}
 
     def get_anchors(self, featmap_shapes, device=None):
         """
@@ -436,13 +497,25 @@ class PointAnchorGenerator(AnchorGenerator):
         return dense_locations
 
     def compute_locations_per_lever(self, h, w, stride, device):
-        shifts_x = torch.arange(0, w * stride, step=stride, dtype=torch.float32, device=device)
-        shifts_y = torch.arange(0, h * stride, step=stride, dtype=torch.float32, device=device)
-        shift_y, shift_x = torch.meshgrid((shifts_y, shifts_x))
-        shift_x = shift_x.reshape(-1)
-        shift_y = shift_y.reshape(-1)
-        locations = torch.stack((shift_x, shift_y), dim=1) + stride // 2 * self.center
+        # strides from the necks are tensors, a new object every forward, key on the value
+        key = (h, w, int(stride), str(device), self.dense_points, self.center)
+        locations = self._loc_cache.get(key, None)
+        if locations is not None:
+            return locations
+
+        # start the shifts at the center offset instead of adding it afterwards
+        offset = stride // 2 * self.center
+        shifts_x = torch.arange(offset, offset + w * stride, step=stride, dtype=torch.float32, device=device)
+        shifts_y = torch.arange(offset, offset + h * stride, step=stride, dtype=torch.float32, device=device)
+        # [h*w, 2], row major over [h, w], written in place instead of meshgrid + stack
+        locations = torch.empty((h * w, 2), dtype=torch.float32, device=device)
+        locations[:, 0] = shifts_x.repeat(h)
+        locations[:, 1] = shifts_y.repeat_interleave(w)
         locations = self.get_dense_locations(locations, stride, device)
+
+        if len(self._loc_cache) >= self._max_cache_size:
+            self._loc_cache.clear()
+        self._loc_cache[key] = locations
         return locations
 
 
@@ -1,8 +1,8 @@
 # Standard Library
 import builtins
 import json
-import copy
 import numpy as np
+from itertools import chain
 
 # Import from third library
 from up.utils.general.log_helper import default_logger as logger
@@ -35,11 +35,10 @@ class KittiEvaluator(Evaluator):
             out = res
         else:
             logger.info(f'loading res from {res_file}')
-            out = []
             with PetrelHelper.open(res_file) as f:
-                for line in f:
-                    out.append(json.loads(line))
-        out = [x for res_gpus in out for res_bs in res_gpus for x in res_bs]
+                out = [PetrelHelper.json_loads(line) for line in f]
+        # [res_gpus][res_bs][x] -> [x]
+        out = list(chain.from_iterable(chain.from_iterable(out)))
         for idx in range(len(out)):
             for k, v in out[idx].items():
                 if isinstance(v, list):
@@ -47,30 +46,29 @@ class KittiEvaluator(Evaluator):
         return out
 
     def get_metric(self, ret):
+        roi_keys = ['recall_roi_%s' % str(cur_thresh) for cur_thresh in self.recall_thresh_list]
+        rcnn_keys = ['recall_rcnn_%s' % str(cur_thresh) for cur_thresh in self.recall_thresh_list]
+        roi_src_keys = ['roi_%s' % str(cur_thresh) for cur_thresh in self.recall_thresh_list]
+        rcnn_src_keys = ['rcnn_%s' % str(cur_thresh) for cur_thresh in self.recall_thresh_list]
         metric = {
             'gt_num': 0,
         }
-        for cur_thresh in self.recall_thresh_list:
-            metric['recall_roi_%s' % str(cur_thresh)] = 0
-            metric['recall_rcnn_%s' % str(cur_thresh)] = 0
+        for roi_key, rcnn_key in zip(roi_keys, rcnn_keys):
+            metric[roi_key] = 0
+            metric[rcnn_key] = 0
 
         for i in range(len(ret)):
             recall_dict = ret[i]['recall_dict']
-            for cur_thresh in self.recall_thresh_list:
-                metric['recall_roi_%s' % str(cur_thresh)] += recall_dict.get('roi_%s' % str(cur_thresh), 0)
-                metric['recall_rcnn_%s' % str(cur_thresh)] += recall_dict.get('rcnn_%s' % str(cur_thresh), 0)
+            for j in range(len(roi_keys)):
+                metric[roi_keys[j]] += recall_dict.get(roi_src_keys[j], 0)
+                metric[rcnn_keys[j]] += recall_dict.get(rcnn_src_keys[j], 0)
             metric['gt_num'] += recall_dict.get('gt', 0)
 
-            disp_dict = {}
-            min_thresh = self.recall_thresh_list[0]
-            disp_dict['recall_%s' % str(min_thresh)] = \
-                '(%d, %d) / %d' % (metric['recall_roi_%s' % str(min_thresh)],
-                                   metric['recall_rcnn_%s' % str(min_thresh)], metric['gt_num'])
         gt_num_cnt = metric['gt_num']
         recall_dict = {}
-        for cur_thresh in self.recall_thresh_list:
-            cur_roi_recall = metric['recall_roi_%s' % str(cur_thresh)] / max(gt_num_cnt, 1)
-            cur_rcnn_recall = metric['recall_rcnn_%s' % str(cur_thresh)] / max(gt_num_cnt, 1)
+        for j, cur_thresh in enumerate(self.recall_thresh_list):
+            cur_roi_recall = metric[roi_keys[j]] / max(gt_num_cnt, 1)
+            cur_rcnn_recall = metric[rcnn_keys[j]] / max(gt_num_cnt, 1)
             logger.info('recall_roi_%s: %f' % (cur_thresh, cur_roi_recall))
             logger.info('recall_rcnn_%s: %f' % (cur_thresh, cur_rcnn_recall))
             recall_dict['recall/roi_%s' % str(cur_thresh)] = cur_roi_recall
@@ -83,10 +81,9 @@ class KittiEvaluator(Evaluator):
             return None, Metric
         det_annos = self.load_dts(res_file, res)
         from .kitti_object_eval_python import eval as kitti_eval
-        eval_det_annos = copy.deepcopy(det_annos)
-        eval_det_annos = sorted(eval_det_annos, key=lambda e: e['frame_id'])
-        eval_gt_annos = [copy.deepcopy(info['annos']) for info in sorted(kitti_infos,
-                                                                         key=lambda e:e['point_cloud']['lidar_idx'])]
+        # kitti_eval only reads the annos, sorting into new lists is enough, no deepcopy needed
+        eval_det_annos = sorted(det_annos, key=lambda e: e['frame_id'])
+        eval_gt_annos = [info['annos'] for info in sorted(kitti_infos, key=lambda e: e['point_cloud']['lidar_idx'])]
         recall_dict = self.get_metric(eval_det_annos)
         result, recall_dict = kitti_eval.get_official_eval_result(eval_gt_annos, eval_det_annos, class_names)
         ave_recall = []
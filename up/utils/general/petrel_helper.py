@@ -2,6 +2,7 @@ import os
 import io
 import torch
 import json
+import numpy as np
 import time
 import configparser
 import pickle as pk
@@ -10,15 +11,31 @@ from collections import defaultdict
 
 from pycocotools.coco import COCO
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 
 class PetrelOpen(object):
     def __init__(self, filename, **kwargs):
+        # substring check on purpose, petrel paths may carry a cluster prefix (cluster:s3://)
+        self._is_s3 = 's3://' in filename
         self.handle = PetrelHelper._petrel_helper.load_data(filename, **kwargs)
 
     def __enter__(self):
         return self.handle
 
     def __exit__(self, exc_type, exc_value, exc_trackback):
+        # local reads hand out file objects which must be closed,
+        # ceph reads hand out line generators or bytes
+        if not self._is_s3 and hasattr(self.handle, 'close'):
+            self.handle.close()
         del self.handle
 
 
@@ -28,6 +45,7 @@ class PetrelHelper(object):
     open = PetrelOpen
 
     default_conf_path = os.environ.get('PETRELPATH', '~/petreloss.conf')
+    read_buffer_size = 1 << 20
 
     def __init__(self, conf_path=default_conf_path):
         self.conf_path = conf_path
@@ -62,9 +80,11 @@ class PetrelHelper(object):
     def load_data(self, path, ceph_read=True, fs_read=False, mode='r'):
         if 's3://' not in path:
             if not fs_read:
-                return open(path, mode)
+                # closed by PetrelOpen on exit
+                return open(path, mode, buffering=self.read_buffer_size)
             else:
-                return open(path, mode).read()
+                with open(path, mode, buffering=self.read_buffer_size) as f:
+                    return f.read()
         else:
             self.check_init()
 
@@ -73,20 +93,50 @@ class PetrelHelper(object):
             else:
                 return self.client.get(path)
 
+    def load_stream(self, path):
+        """return a binary file-like object that is read lazily"""
+        if 's3://' not in path:
+            return open(path, 'rb')
+        else:
+            self.check_init()
+            return self.client.get(path, enable_stream=True, no_cache=True)
+
     @staticmethod
     def load_pk(path, mode='r'):
         if 's3://' not in path:
-            pk_res = pk.load(open(path, mode))
+            with open(path, mode) as f:
+                pk_res = pk.load(f)
         else:
             pk_res = pk.loads(PetrelHelper._petrel_helper.load_data(path, ceph_read=False))
         return pk_res
 
     @staticmethod
-    def load_json(path, mode='r'):
+    def load_npy(path):
         if 's3://' not in path:
-            js = json.load(open(path, mode))
+            arr = np.load(path)
         else:
-            js = json.loads(PetrelHelper._petrel_helper.load_data(path, ceph_read=False))
+            arr = np.load(io.BytesIO(PetrelHelper._petrel_helper.load_data(path, ceph_read=False)))
+        return arr
+
+    @staticmethod
+    def json_loads(data):
+        """parse a json str or bytes, with orjson when it is available"""
+        if orjson is not None:
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                # orjson rejects NaN/Infinity, which python's json writes by default
+                pass
+        return json.loads(data)
+
+    @staticmethod
+    def load_json(path, mode='rb'):
+        # both orjson and json accept raw bytes, which skips the text-mode decode pass
+        if 's3://' not in path:
+            with open(path, mode) as f:
+                js = PetrelHelper.json_loads(f.read())
+        else:
+            js = PetrelHelper.json_loads(PetrelHelper._petrel_helper.load_data(path, ceph_read=False))
         return js
 
     def load_pretrain(self, path, map_location=None):
@@ -150,11 +200,13 @@ __petrel_helper = PetrelHelper()
 
 
 class PetrelCOCO(COCO):
-    def __init__(self, annotation_file=None):
+    def __init__(self, annotation_file=None, streaming=False):
         """
         Constructor of Microsoft COCO helper class for reading and visualizing annotations.
         :param annotation_file (str): location of annotation file
         :param image_folder (str): location to the folder that hosts images.
+        :param streaming (bool): parse the annotation file incrementally with ijson instead of
+            reading it into memory first, for annotation files too large to load at once
         :return:
         """
         # load dataset
@@ -163,7 +215,17 @@ class PetrelCOCO(COCO):
         if annotation_file is not None:
             print('loading annotations into memory...')
             tic = time.time()
-            dataset = PetrelHelper.load_json(annotation_file)
+            if streaming:
+                if ijson is None:
+                    raise ImportError('ijson is required for streaming annotation loading')
+                fileobj = PetrelHelper._petrel_helper.load_stream(annotation_file)
+                try:
+                    # each top-level value is built by the ijson backend straight from the stream
+                    dataset = dict(ijson.kvitems(fileobj, '', use_float=True))
+                finally:
+                    fileobj.close()
+            else:
+                dataset = PetrelHelper.load_json(annotation_file)
             assert type(dataset) == dict, 'annotation file format {} not supported'.format(type(dataset))
             print('Done (t={:0.2f}s)'.format(time.time() - tic))
             self.dataset = dataset